@@ -4,7 +4,12 @@ DB_TYPE = "fuseki"  # options: "fuseki" | "graphdb"
 DB_BASE_URI = os.environ.get("DB_BASE_URI", "")
 DB_USERNAME = os.environ.get("DB_USERNAME", "")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
-TIMEOUT = float(os.environ.get("TIMEOUT", "20.0"))
+TIMEOUT = float(os.environ.get("TIMEOUT", "60.0"))
+QUERY_BATCH_SIZE = 10  # number of graphs fetched per query when checking for changes
+MAX_CONCURRENT_QUERIES = 8  # max number of queries sent to the triplestore at once
+GZIP_UPLOADS = DB_TYPE == "fuseki"  # gzips graph uploads, if the triplestore accepts it
+GZIP_MIN_SIZE = 16 * 1024  # min size in bytes of graph uploads to gzip
+UPDATE_CHUNK_SIZE = 50000  # max number of triples per update for modified datasets
 SHOW_WARNINGS = True
 WARNINGS_INVALID = False  # Allows warnings to flag as invalid when true
 DROP_ON_START = False  # Drops all graphs when updating vocabs
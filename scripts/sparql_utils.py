@@ -1,9 +1,39 @@
-from typing import List, Dict
+import asyncio
+import gzip
+import os
+import zlib
+from typing import List, Dict, IO, Iterator, Tuple, Union
 
 import httpx
 
 from config import *
 
+# shared client so connections are kept alive across requests
+_client = httpx.Client(auth=(DB_USERNAME, DB_PASSWORD), timeout=TIMEOUT)
+
+
+def _gzip_stream(f: IO[bytes], chunk_size: int = 65536) -> Iterator[bytes]:
+    """Gzips a file in chunks, without reading it fully into memory"""
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 31)  # wbits=31 for gzip
+    while chunk := f.read(chunk_size):
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def _encode_content(
+    content: Union[bytes, IO[bytes]]
+) -> Tuple[Union[bytes, IO[bytes], Iterator[bytes]], Dict[str, str]]:
+    """Gzips request content over GZIP_MIN_SIZE, returning the content & any headers"""
+    if not GZIP_UPLOADS:
+        return content, {}
+    if isinstance(content, bytes):
+        if len(content) < GZIP_MIN_SIZE:
+            return content, {}
+        return gzip.compress(content, 1), {"Content-Encoding": "gzip"}
+    if os.fstat(content.fileno()).st_size < GZIP_MIN_SIZE:
+        return content, {}
+    return _gzip_stream(content), {"Content-Encoding": "gzip"}
+
 
 def sparql_query(q: str) -> List[Dict]:
     endpoint = ""
@@ -16,15 +46,40 @@ def sparql_query(q: str) -> List[Dict]:
             "Unsupported DB type. Supported types are: 'fuseki', 'graphdb'."
         )
 
-    response = httpx.get(
+    response = _client.get(
+        endpoint,
+        params={"query": q},
+        headers={
+            "Accept": "application/sparql-results+json",
+            "Content-Type": "application/sparql-query",
+        },
+    )
+    if 200 <= response.status_code < 300:
+        return response.json()["results"]["bindings"]
+    else:
+        raise Exception(
+            f"SPARQL query error code {response.status_code}: {response.text}"
+        )
+
+
+async def sparql_query_async(client: httpx.AsyncClient, q: str) -> List[Dict]:
+    endpoint = ""
+    if DB_TYPE == "fuseki":
+        endpoint = f"{DB_BASE_URI}/query"
+    elif DB_TYPE == "graphdb":
+        endpoint = f"{DB_BASE_URI}"
+    else:  # unsupported db type
+        raise ValueError(
+            "Unsupported DB type. Supported types are: 'fuseki', 'graphdb'."
+        )
+
+    response = await client.get(
         endpoint,
         params={"query": q},
         headers={
             "Accept": "application/sparql-results+json",
             "Content-Type": "application/sparql-query",
         },
-        auth=(DB_USERNAME, DB_PASSWORD),
-        timeout=TIMEOUT,
     )
     if 200 <= response.status_code < 300:
         return response.json()["results"]["bindings"]
@@ -34,6 +89,25 @@ def sparql_query(q: str) -> List[Dict]:
         )
 
 
+def sparql_query_many(queries: List[str]) -> List[List[Dict]]:
+    """Runs several SPARQL queries concurrently, returning results in query order"""
+
+    async def gather() -> List[List[Dict]]:
+        # bound concurrency so as not to overload the triplestore
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+        async with httpx.AsyncClient(
+            auth=(DB_USERNAME, DB_PASSWORD), timeout=TIMEOUT
+        ) as client:
+
+            async def query(q: str) -> List[Dict]:
+                async with semaphore:
+                    return await sparql_query_async(client, q)
+
+            return await asyncio.gather(*[query(q) for q in queries])
+
+    return asyncio.run(gather())
+
+
 def sparql_update(q: str) -> bool:
     endpoint = ""
     if DB_TYPE == "fuseki":
@@ -45,14 +119,12 @@ def sparql_update(q: str) -> bool:
             "Unsupported DB type. Supported types are: 'fuseki', 'graphdb'."
         )
 
-    response = httpx.post(
+    response = _client.post(
         endpoint,
         data={"update": q},
         # headers={
         #     "Content-Type": "application/sparql-update",
         # },
-        auth=(DB_USERNAME, DB_PASSWORD),
-        timeout=TIMEOUT,
     )
     if 200 <= response.status_code < 300:
         return True
@@ -62,7 +134,11 @@ def sparql_update(q: str) -> bool:
         )
 
 
-def sparql_insert_graph(graph_uri: str, graph_content: bytes) -> bool:
+def sparql_insert_graph(
+    graph_uri: str,
+    graph_content: Union[bytes, IO[bytes]],
+    content_type: str = "text/turtle",
+) -> bool:
     params = {}
     endpoint = ""
     if DB_TYPE == "fuseki":
@@ -76,15 +152,15 @@ def sparql_insert_graph(graph_uri: str, graph_content: bytes) -> bool:
             "Unsupported DB type. Supported types are: 'fuseki', 'graphdb'."
         )
 
-    response = httpx.post(
+    content, headers = _encode_content(graph_content)
+    response = _client.post(
         endpoint,
         params=params,
         headers={
-            "Content-Type": "text/turtle",
+            "Content-Type": content_type,
+            **headers,
         },
-        content=graph_content,
-        auth=(DB_USERNAME, DB_PASSWORD),
-        timeout=TIMEOUT,
+        content=content,
     )
     if 200 <= response.status_code < 300:
         return True
@@ -105,15 +181,13 @@ def sparql_construct(q: str) -> str:
             "Unsupported DB type. Supported types are: 'fuseki', 'graphdb'."
         )
 
-    response = httpx.get(
+    response = _client.get(
         endpoint,
         params={"query": q},
         headers={
             "Accept": "text/turtle",
             "Content-Type": "application/sparql-query",
         },
-        auth=(DB_USERNAME, DB_PASSWORD),
-        timeout=TIMEOUT,
     )
     if 200 <= response.status_code < 300:
         return response.text
@@ -1,20 +1,93 @@
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Set, AbstractSet, Optional, Iterable, Hashable
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import mmap
+import os
+import re
 import uuid
 
-from rdflib import Dataset, Graph, URIRef, Namespace
-from rdflib.namespace import RDF, RDFS, DCTERMS, DCAT
-from rdflib.compare import isomorphic, to_isomorphic
+import rdflib
+from rdflib import Dataset, Graph, URIRef, Namespace, BNode, Literal
+from rdflib.namespace import RDF, RDFS, DCTERMS, DCAT, XSD
+from rdflib.compare import isomorphic
+from rdflib.plugins.sparql import prepareQuery, prepareUpdate
+from rdflib.term import Identifier
 
 from config import *
 from sparql_utils import *
 
+# keep literals' lexical forms as written, so changed triples are sent to the
+# triplestore exactly as they were stored from the file
+rdflib.NORMALIZE_LITERALS = False
+
 GEO = Namespace("http://www.opengis.net/ont/geosparql#")
+STATE_CACHE = Path(__file__).parent.parent / ".cache" / "surround_prez_state.json"
+
+_PREFIXES = (
+    f"PREFIX dcterms: <{DCTERMS}>\n"
+    f"PREFIX geo: <{GEO}>\n"
+    f"PREFIX rdfs: <{RDFS}>\n"
+    f"PREFIX dcat: <{DCAT}>\n"
+)
+
+# turtle IRI or prefixed name
+_TERM = rb"<[^>\s]*>|[\w\-.]*:[\w\-.]*"
+_PREFIX_PATTERN = re.compile(
+    rb"^\s*(?:@prefix|(?i:PREFIX))\s+([\w\-.]*):\s*<([^>\s]*)>", re.MULTILINE
+)
+# a statement starting a line whose first predicate is `a`/`rdf:type`
+_TYPE_PATTERN = re.compile(
+    rb"^(" + _TERM + rb")\s+(?:a|(" + _TERM + rb"))\s+"
+    rb"((?:(?:" + _TERM + rb")\s*,\s*)*(?:" + _TERM + rb"))\s*[;.]",
+    re.MULTILINE,
+)
+
+# IRIs that start with a scheme, as relative IRIs need the file's base to resolve
+_ABSOLUTE_IRI = re.compile(r"^[A-Za-z][A-Za-z0-9+\-.]*:")
+
+_NS = {"dcterms": DCTERMS, "geo": GEO, "rdfs": RDFS, "dcat": DCAT}
+
+# queries run against in-memory graphs, parsed once at import time
+_GET_ID = prepareQuery(
+    """
+    SELECT ?id
+    WHERE {
+        ?c dcterms:identifier ?id .
+    }
+""",
+    initNs=_NS,
+)
+_INSERT_MEMBERS = prepareUpdate(
+    """
+    INSERT {
+        GRAPH ?system {
+            ?fc_a rdfs:member ?f_a .
+            ?f_b dcterms:isPartOf ?fc_b .
+        }
+    }
+    WHERE {
+        GRAPH ?content {
+            OPTIONAL {
+                ?f_a a geo:Feature ;
+                    dcterms:isPartOf ?fc_a .
+                ?fc_a a geo:FeatureCollection .
+            }
+            OPTIONAL {
+                ?fc_b a geo:FeatureCollection ;
+                    rdfs:member ?f_b .
+                ?f_b a geo:Feature .
+            }
+        }
+    }
+""",
+    initNs=_NS,
+)
 
 
-def get_remote_datasets() -> List[str]:
+def get_remote_datasets() -> Set[str]:
     """Gets all datasets in the triplestore"""
-    datasets = []
     results = sparql_query(
         """
         SELECT DISTINCT ?g
@@ -26,21 +99,62 @@ def get_remote_datasets() -> List[str]:
         }
     """
     )
-
-    for result in results:
-        datasets.append(result["g"]["value"])
-    return datasets
+    return {result["g"]["value"] for result in results}
+
+
+def _expand(term: bytes, prefixes: Dict[bytes, str]) -> Optional[str]:
+    """Expands a turtle IRI or prefixed name, or None if it can't be resolved"""
+    if term.startswith(b"<"):
+        iri = term[1:-1].decode()
+    else:
+        prefix, _, local = term.partition(b":")
+        if prefix not in prefixes:
+            return None
+        iri = prefixes[prefix] + local.decode()
+    # escapes like \uXXXX need unescaping by the parser
+    return iri if _ABSOLUTE_IRI.match(iri) and "\\" not in iri else None
+
+
+def _scan_for_dataset(content: bytes) -> Optional[str]:
+    """Scans turtle for an `<s> a dcat:Dataset` statement, or None if not found"""
+    # statements after a long string could be inside it, so only scan up to the first
+    delimiters = [i for i in (content.find(b'"""'), content.find(b"'''")) if i != -1]
+    end = min(delimiters, default=len(content))
+
+    prefixes = {}
+    for m in _PREFIX_PATTERN.finditer(content, 0, end):
+        # a redeclared prefix means different parts of the file expand differently
+        if prefixes.setdefault(m.group(1), m.group(2).decode()) != m.group(2).decode():
+            return None
+    for m in _TYPE_PATTERN.finditer(content, 0, end):
+        if m.group(2) is not None and _expand(m.group(2), prefixes) != str(RDF.type):
+            continue
+        objects = [_expand(o.strip(), prefixes) for o in m.group(3).split(b",")]
+        if str(DCAT.Dataset) in objects:
+            s = _expand(m.group(1), prefixes)
+            if s is not None:
+                return s
+    return None
 
 
 def get_graph_uri_for_dataset(dataset: Path) -> URIRef:
     """We can get the Graph URI for a dataset from the dataset file as we know that
     there is only one Dataset per file"""
-    g = Graph().parse(str(dataset), format="ttl")
+    # scan for an `<s> a dcat:Dataset` statement before resorting to a full parse
+    if dataset.stat().st_size > 0:
+        with open(dataset, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as content:
+            s = _scan_for_dataset(content)
+        if s is not None:
+            return URIRef(s)
+
+    g = Graph(store="SimpleMemory").parse(str(dataset), format="ttl")
     for s in g.subjects(predicate=RDF.type, object=DCAT.Dataset):
         return s
 
 
-def get_local_datasets() -> Dict:
+def get_local_datasets() -> Dict[str, Path]:
     """Gets all datasets in the local `data/` directory"""
     datasets = {}
     for f in Path(__file__).parent.parent.glob("data/**/*.ttl"):
@@ -50,11 +164,11 @@ def get_local_datasets() -> Dict:
 
 
 def get_diff(
-    local_datasets_list: List[str], remote_datasets: List[str]
-) -> Tuple[List[str]]:
+    local_datasets: AbstractSet[str], remote_datasets: AbstractSet[str]
+) -> Tuple[List[str], List[str]]:
     """Gets the difference between the local datasets and the triplestore datasets"""
-    to_be_added = list(set(local_datasets_list) - set(remote_datasets))
-    to_be_deleted = list(set(remote_datasets) - set(local_datasets_list))
+    to_be_added = list(local_datasets - remote_datasets)
+    to_be_deleted = list(remote_datasets - local_datasets)
     return (to_be_added, to_be_deleted)
 
 
@@ -71,6 +185,17 @@ def add_datasets(datasets: List[str], local_datasets: Dict[str, str]):
     #     add_to_default(dataset)
 
 
+def update_datasets(
+    datasets: Dict[str, Tuple[List[Tuple], List[Tuple], List[Tuple]]],
+    local_datasets: Dict[str, str],
+):
+    """Applies the changed triples of the datasets flagged as modified."""
+    for dataset, (to_insert, to_delete, bnode_groups) in datasets.items():
+        update_graph(
+            dataset, local_datasets[dataset], to_insert, to_delete, bnode_groups
+        )
+
+
 def delete_datasets(datasets: List[str]):
     """Drops the default union graph from the triplestore and
     deletes datasets flagged for deletion."""
@@ -85,33 +210,92 @@ def delete_datasets(datasets: List[str]):
 
 def add_graph(graph_uri: str, graph_file: Path) -> None:
     """Adds a graph to the triplestore"""
+    add_system_graph(graph_uri, graph_file)
+
+    # add graph to triplestore, streamed from the file
+    with open(graph_file, "rb") as f:
+        sparql_insert_graph(graph_uri, f)
+
+
+def update_graph(
+    graph_uri: str,
+    graph_file: Path,
+    to_insert: List[Tuple],
+    to_delete: List[Tuple],
+    bnode_groups: List[Tuple[Optional[List[Tuple]], List[Tuple]]] = (),
+) -> None:
+    """Applies only the changed triples of a modified graph to the triplestore,
+    replacing each of the (remote, local) groups of blank node triples in
+    `bnode_groups`. A remote group of None stands for all blank node triples."""
+    # delete & insert each chunk in one request, so it can't be left half applied
+    for i in range(0, max(len(to_delete), len(to_insert)), UPDATE_CHUNK_SIZE):
+        operations = []
+        if to_delete[i : i + UPDATE_CHUNK_SIZE]:
+            operations.append(
+                f"""
+            DELETE DATA {{
+                GRAPH <{graph_uri}> {{
+                    {_ntriples(to_delete[i : i + UPDATE_CHUNK_SIZE])}
+                }}
+            }}"""
+            )
+        if to_insert[i : i + UPDATE_CHUNK_SIZE]:
+            operations.append(
+                f"""
+            INSERT DATA {{
+                GRAPH <{graph_uri}> {{
+                    {_ntriples(to_insert[i : i + UPDATE_CHUNK_SIZE])}
+                }}
+            }}"""
+            )
+        sparql_update(" ;\n".join(operations))
+
+    # chunks are only split between groups, so each group's blank node labels stay
+    # within one INSERT DATA
+    for chunk in _chunk_groups(bnode_groups):
+        operations = [
+            _delete_bnode_group(graph_uri, remote)
+            for remote, _ in chunk
+            if remote is None or remote
+        ]
+        local = [triple for _, group in chunk for triple in group]
+        if local:
+            operations.append(
+                f"""
+            INSERT DATA {{
+                GRAPH <{graph_uri}> {{
+                    {_ntriples(local)}
+                }}
+            }}"""
+            )
+        sparql_update(" ;\n".join(operations))
+
+    # rebuild system graph, as IDs & members may have changed
+    drop_system_graph(graph_uri)
+    add_system_graph(graph_uri, graph_file)
+
+
+def add_system_graph(graph_uri: str, graph_file: Path) -> None:
+    """Creates the system graph for a graph & adds it to the triplestore"""
     d = Dataset()
     content_graph = d.graph(identifier=graph_uri)
     content_graph.parse(graph_file)
 
     # check for ID, error if has id but not unique
-    r = content_graph.query(
-        f"""
-        PREFIX dcterms: <{DCTERMS}>
-        SELECT ?id
-        WHERE {{
-            <{graph_uri}> dcterms:identifier ?id .
-        }}
-    """
-    )
+    r = content_graph.query(_GET_ID, initBindings={"c": URIRef(graph_uri)})
     if r.bindings:
         id = str(r.bindings[0]["id"])
-        for key, value in id_dict.items():
-            if value == id and key != graph_uri:
-                raise Exception("Provided ID is not unique")
+        owner = id_to_uri.get(id)
+        if owner is not None and owner != graph_uri:
+            raise Exception("Provided ID is not unique")
 
     # create system graph with inference
     system_graph = create_system_graph(graph_uri, content_graph, d)
 
     # add seeAlso triple to triplestore
     sparql_update(
-        f"""
-        PREFIX rdfs: <{RDFS}>
+        _PREFIXES
+        + f"""
         INSERT DATA {{
             GRAPH <system:> {{
                 <{graph_uri}> rdfs:seeAlso <{system_graph.identifier}> .
@@ -120,57 +304,31 @@ def add_graph(graph_uri: str, graph_file: Path) -> None:
     """
     )
 
-    # add system graph to triplestore
+    # add system graph to triplestore as N-Triples, which is cheaper to serialize
     sparql_insert_graph(
-        system_graph.identifier, system_graph.serialize(format="turtle")
+        system_graph.identifier,
+        system_graph.serialize(format="nt", encoding="utf-8"),
+        content_type="application/n-triples",
     )
 
-    # add graph to triplestore
-    with open(graph_file, "rb") as f:
-        graph_content = f.read()
-    sparql_insert_graph(graph_uri, graph_content)
-
     # update seeAlso dict
     mapping_dict[graph_uri] = str(system_graph.identifier)
+    invalidate_state()
 
 
-def create_id(content_graph: Graph, system_graph: Graph, uri: str) -> str:
-    """Creates an ID if doesn't exist & checks for uniqueness"""
-    # either get ID or generate one if none exists
-    r = content_graph.query(
-        f"""
-        PREFIX dcterms: <{DCTERMS}>
-        CONSTRUCT {{
-            ?c dcterms:identifier ?id .
-        }}
-        WHERE {{
-            BIND (<{uri}> as ?c)
-            OPTIONAL {{
-                ?c dcterms:identifier ?given_id .
-            }}
-            BIND (REPLACE(STR(?c), ".*[/|#|:](.*)$", "$1") AS ?uri_id)
-            BIND (COALESCE(?given_id, ?uri_id) AS ?id)
-        }}
-    """
-    )
+def _local_name(uri: str) -> str:
+    """Gets the part of a URI after the last `/`, `#`, `:` or `|`"""
+    return uri[max(uri.rfind(c) for c in "/#:|") + 1 :]
 
-    # get generated id as variable
-    r2 = r.graph.query(
-        f"""
-        PREFIX dcterms: <{DCTERMS}>
-        SELECT ?id
-        WHERE {{
-            ?c dcterms:identifier ?id .
-        }}
-    """
-    )
-    id = r2.bindings[0]["id"]
 
+def create_id(uri: str, id: Literal) -> Literal:
+    """Checks a given or generated ID for uniqueness & records it"""
     # check for uniqueness, retry once by adding a "1" to the id
     retries = 0
     while retries < 2:
-        # check that ID is unique
-        if id not in id_dict.values():
+        # check that ID is unique, or already belongs to this URI
+        owner = id_to_uri.get(str(id))
+        if owner is None or owner == str(uri):
             break
 
         retries += 1
@@ -178,11 +336,12 @@ def create_id(content_graph: Graph, system_graph: Graph, uri: str) -> str:
             raise Exception(f"Unable to generate unique ID for {uri}")
         id += 1
 
-    # add ID to system graph
-    system_graph.add((URIRef(uri), DCTERMS.identifier, id))
-
-    # update ID dict
+    # update ID dicts
+    uri = str(uri)
+    if uri in id_dict:
+        id_to_uri.pop(str(id_dict[uri]), None)
     id_dict[uri] = id
+    id_to_uri[str(id)] = uri
 
     return id
 
@@ -193,50 +352,26 @@ def create_system_graph(
     """Creates a system graph for a content graph and populates it with inferred data"""
     system_graph = dataset.graph(identifier=f"system:{uuid.uuid4()}")
 
-    # generate IDs for datasets, feature collections & features
-    r = content_graph.query(
-        f"""
-        PREFIX dcat: <{DCAT}>
-        PREFIX geo: <{GEO}>
-        SELECT ?s
-        WHERE {{
-            ?s a ?o .
-            FILTER (?o IN (dcat:Dataset, geo:FeatureCollection, geo:Feature)) .
-        }}
-    """
-    )
-    for binding in r.bindings:
-        s_id = create_id(content_graph, system_graph, binding["s"])
+    # either get or generate IDs for all datasets, feature collections & features
+    quads = []
+    seen = set()
+    for o in (DCAT.Dataset, GEO.FeatureCollection, GEO.Feature):
+        for s in content_graph.subjects(RDF.type, o):
+            if s in seen:
+                continue
+            seen.add(s)
+            # only use the first ID if given multiple
+            given_id = next(content_graph.objects(s, DCTERMS.identifier), None)
+            id = given_id if given_id is not None else Literal(_local_name(s))
+            quads.append((s, DCTERMS.identifier, create_id(s, id), system_graph))
+    system_graph.addN(quads)
 
     # create titles for features
 
     # insert rdfs:member where dcterms:isPartOf & vice-versa
     dataset.update(
-        f"""
-        PREFIX dcterms: <{DCTERMS}>
-        PREFIX geo: <{GEO}>
-        PREFIX rdfs: <{RDFS}>
-        INSERT {{
-            GRAPH <{system_graph.identifier}> {{
-                ?fc_a rdfs:member ?f_a .
-                ?f_b dcterms:isPartOf ?fc_b .
-            }}
-        }}
-        WHERE {{
-            GRAPH <{graph_uri}> {{
-                OPTIONAL {{
-                    ?f_a a geo:Feature ;
-                        dcterms:isPartOf ?fc_a .
-                    ?fc_a a geo:FeatureCollection .
-                }}
-                OPTIONAL {{
-                    ?fc_b a geo:FeatureCollection ;
-                        rdfs:member ?f_b .
-                    ?f_b a geo:Feature .
-                }}
-            }}
-        }}
-    """
+        _INSERT_MEMBERS,
+        initBindings={"system": system_graph.identifier, "content": URIRef(graph_uri)},
     )
 
     return system_graph
@@ -250,6 +385,17 @@ def add_to_default(graph_uri: str) -> None:
 
 def drop_graph(graph_uri: str) -> None:
     """Drops a graph from the triplestore"""
+    drop_system_graph(graph_uri)
+    sparql_update(f"DROP GRAPH <{graph_uri}>")
+
+    # remove from ID dicts
+    id = id_dict.pop(graph_uri)
+    id_to_uri.pop(str(id), None)
+    invalidate_state()
+
+
+def drop_system_graph(graph_uri: str) -> None:
+    """Drops the system graph for a graph from the triplestore"""
     # delete seeAlso records
     sparql_update(
         f"""
@@ -263,70 +409,405 @@ def drop_graph(graph_uri: str) -> None:
     """
     )
     sparql_update(f"DROP GRAPH <{mapping_dict[graph_uri]}>")
-    sparql_update(f"DROP GRAPH <{graph_uri}>")
 
-    # remove from seeAlso & ID dicts
+    # remove from seeAlso dict
     mapping_dict.pop(graph_uri)
-    id_dict.pop(graph_uri)
+    invalidate_state()
 
 
-def get_modified_datasets(local_datasets: Dict[str, str]) -> List[str]:
-    """Gets a list of the graphs that have been modified"""
-    modified = []
-    for uri, filename in local_datasets.items():
-        # compare remote vs local graphs
-        r = sparql_construct(
-            f"""
-            CONSTRUCT {{
+def _norm_literal(o: Literal) -> Tuple[str, Optional[str], Optional[str]]:
+    """Normalises a literal to (canonical lexical form, lang, datatype), dropping the
+    `@en` & `^^xsd:string` tags that get omitted in the remote version"""
+    lang = None if o.language == "en" else o.language
+    datatype = None if o.datatype in (None, XSD.string) else str(o.datatype)
+    if datatype is None:
+        return (str(o), lang, datatype)
+    return (str(Literal(str(o), datatype=o.datatype, normalize=True)), lang, datatype)
+
+
+def _norm_term(o: Identifier) -> Identifier:
+    """Normalises a term if it is a literal"""
+    if isinstance(o, Literal):
+        lexical, lang, datatype = _norm_literal(o)
+        return Literal(lexical, lang=lang, datatype=datatype)
+    return o
+
+
+def _norm_graph(triples: Iterable[Tuple]) -> Graph:
+    """Creates a graph of the given triples with their literals normalised"""
+    norm = Graph(store="SimpleMemory")
+    norm.addN((s, p, _norm_term(o), norm) for s, p, o in triples)
+    return norm
+
+
+def _triple_key(s: Identifier, p: Identifier, o: Identifier) -> Tuple:
+    """Gets a normalised key for comparing triples without blank nodes"""
+    return (str(s), str(p), _norm_literal(o) if isinstance(o, Literal) else str(o))
+
+
+def _triple_map(triples: Iterable[Tuple]) -> Dict[Tuple, Tuple]:
+    """Maps the normalised keys of triples to the triples themselves"""
+    return {_triple_key(*triple): triple for triple in triples}
+
+
+def _ntriples(triples: List[Tuple]) -> str:
+    """Formats triples as N-Triples for use in a SPARQL update"""
+    return "\n".join(f"{s.n3()} {p.n3()} {o.n3()} ." for s, p, o in triples)
+
+
+def _has_bnode(s: Identifier, p: Identifier, o: Identifier) -> bool:
+    """Checks whether a triple contains a blank node"""
+    return isinstance(s, BNode) or isinstance(o, BNode)
+
+
+def _has_bnodes(g: Graph) -> bool:
+    """Checks whether a graph contains any blank nodes"""
+    return any(_has_bnode(*triple) for triple in g)
+
+
+def _split_bnodes(g: Graph) -> Tuple[List[Tuple], List[Tuple]]:
+    """Splits a graph's triples into those without & with blank nodes"""
+    plain, bnode = [], []
+    for triple in g:
+        (bnode if _has_bnode(*triple) else plain).append(triple)
+    return plain, bnode
+
+
+def _bnode_groups(
+    remote: List[Tuple], local: List[Tuple]
+) -> Dict[Optional[Hashable], Tuple[List[Tuple], List[Tuple]]]:
+    """Pairs up the remote & local blank node triples connected to the same named
+    subjects into (remote, local) groups. Triples that no named subject points to
+    are grouped under None."""
+    parent = {}
+
+    def find(node: Hashable) -> Hashable:
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    # join each side's blank nodes to each other & to the named subjects above them,
+    # which are shared by both sides
+    entries = []
+    for side, triples in ((0, remote), (1, local)):
+        for s, p, o in triples:
+            node = find((side, s) if isinstance(s, BNode) else (side, o))
+            if isinstance(s, BNode) and isinstance(o, BNode):
+                parent[find((side, o))] = node
+            elif not isinstance(s, BNode):
+                parent[node] = find(s)
+            entries.append((side, (s, p, o), node))
+
+    anchored = {find(node) for node in parent if not isinstance(node, tuple)}
+    groups = {}
+    for side, triple, node in entries:
+        key = find(node) if find(node) in anchored else None
+        groups.setdefault(key, ([], []))[side].append(triple)
+    return groups
+
+
+def _chunk_groups(groups: List[Tuple]) -> List[List[Tuple]]:
+    """Splits (remote, local) groups of triples into chunks of up to
+    UPDATE_CHUNK_SIZE triples, without splitting a group"""
+    chunks = []
+    size = UPDATE_CHUNK_SIZE
+    for remote, local in groups:
+        n = len(remote or ()) + len(local)
+        if size + n > UPDATE_CHUNK_SIZE:
+            chunks.append([])
+            size = 0
+        chunks[-1].append((remote, local))
+        size += n
+    return chunks
+
+
+def _delete_bnode_group(graph_uri: str, triples: Optional[List[Tuple]]) -> str:
+    """Formats a SPARQL update deleting a group of blank node triples, matched by
+    using their blank nodes as variables, or all blank node triples if None"""
+    if triples is None:
+        return f"""
+            WITH <{graph_uri}>
+            DELETE {{
                 ?s ?p ?o .
             }}
             WHERE {{
-                GRAPH <{uri}> {{
-                    ?s ?p ?o .
-                }}
+                ?s ?p ?o .
+                FILTER (isBlank(?s) || isBlank(?o))
+            }}"""
+
+    variables = {}
+
+    def n3(term: Identifier) -> str:
+        if isinstance(term, BNode):
+            return variables.setdefault(term, f"?b{len(variables)}")
+        return term.n3()
+
+    pattern = "\n".join(f"{n3(s)} {n3(p)} {n3(o)} ." for s, p, o in triples)
+    blank = " && ".join(f"isBlank({v})" for v in variables.values())
+    return f"""
+            WITH <{graph_uri}>
+            DELETE {{
+                {pattern}
             }}
-        """
+            WHERE {{
+                {pattern}
+                FILTER ({blank})
+            }}"""
+
+
+def _term(binding: Dict) -> Identifier:
+    """Converts a SPARQL JSON result binding to an RDFLib term"""
+    if binding["type"] == "uri":
+        return URIRef(binding["value"])
+    elif binding["type"] == "bnode":
+        return BNode(binding["value"])
+    else:  # literal or typed-literal
+        return Literal(
+            binding["value"],
+            lang=binding.get("xml:lang"),
+            datatype=binding.get("datatype"),
+            normalize=False,
         )
-        g_remote = Graph().parse(data=r, format="turtle")
-        if len(g_remote) == 0:  # remote dataset doesn't exist
+
+
+def _parse_local(filename: str) -> Graph:
+    """Parses a local dataset into a lightweight graph"""
+    return Graph(store="SimpleMemory").parse(str(filename), format="turtle")
+
+
+def _values_batches(graph_uris: List[str]) -> List[str]:
+    """Splits graph URIs into batches of QUERY_BATCH_SIZE for use in VALUES clauses"""
+    return [
+        " ".join(f"<{uri}>" for uri in graph_uris[i : i + QUERY_BATCH_SIZE])
+        for i in range(0, len(graph_uris), QUERY_BATCH_SIZE)
+    ]
+
+
+def _sketch_line(s: Identifier, p: Identifier, o: Identifier) -> str:
+    """Formats a triple without blank nodes the same way as the remote sketch query"""
+    if isinstance(o, Literal):
+        # the remote side hashes the stored lexical form, not the canonical one
+        _, lang, datatype = _norm_literal(o)
+        return f"{s} {p} L {o} {lang or ''} {datatype or ''}"
+    return f"{s} {p} I {o}  "
+
+
+def _digest(g: Graph) -> str:
+    """Gets an order-independent digest of a graph without blank nodes"""
+    hashes = sorted(hashlib.md5(_sketch_line(*t).encode()).hexdigest() for t in g)
+    return hashlib.md5("\n".join(hashes).encode()).hexdigest()
+
+
+def get_remote_sketches(graph_uris: List[str]) -> Dict[str, Tuple[int, Optional[str]]]:
+    """Gets the (triple count, digest) of the given graphs from the triplestore,
+    computed the same way as _digest"""
+    queries = [
+        f"""
+        SELECT ?g (COUNT(*) AS ?count) (MD5(GROUP_CONCAT(?h ; separator="\\n")) AS ?digest)
+        WHERE {{
+            {{
+                SELECT ?g ?h
+                WHERE {{
+                    VALUES ?g {{ {values} }}
+                    GRAPH ?g {{
+                        ?s ?p ?o .
+                    }}
+                    BIND (IF(LANG(?o) = "en", "", LANG(?o)) AS ?lang)
+                    BIND (
+                        IF(
+                            LANG(?o) = "" && DATATYPE(?o) != <{XSD.string}>,
+                            STR(DATATYPE(?o)),
+                            ""
+                        ) AS ?datatype
+                    )
+                    BIND (
+                        MD5(
+                            IF(
+                                isLiteral(?o),
+                                CONCAT(STR(?s), " ", STR(?p), " L ", STR(?o), " ", ?lang, " ", ?datatype),
+                                CONCAT(STR(?s), " ", STR(?p), " I ", STR(?o), "  ")
+                            )
+                        ) AS ?h
+                    )
+                }}
+                ORDER BY ?g ?h
+            }}
+        }}
+        GROUP BY ?g
+    """
+        for values in _values_batches(graph_uris)
+    ]
+
+    sketches = {}
+    for results in sparql_query_many(queries):
+        for result in results:
+            digest = result.get("digest", {}).get("value")
+            sketches[result["g"]["value"]] = (int(result["count"]["value"]), digest)
+    return sketches
+
+
+def get_remote_graphs(graph_uris: List[str]) -> Dict[str, Graph]:
+    """Gets the content of the given graphs from the triplestore, fetching batches of
+    graphs concurrently"""
+    queries = [
+        f"""
+        SELECT ?g ?s ?p ?o
+        WHERE {{
+            VALUES ?g {{ {values} }}
+            GRAPH ?g {{
+                ?s ?p ?o .
+            }}
+        }}
+    """
+        for values in _values_batches(graph_uris)
+    ]
+
+    triples = {}
+    for results in sparql_query_many(queries):
+        for result in results:
+            triples.setdefault(result["g"]["value"], []).append(
+                (_term(result["s"]), _term(result["p"]), _term(result["o"]))
+            )
+
+    graphs = {}
+    for uri, graph_triples in triples.items():
+        g = Graph(store="SimpleMemory")
+        g.addN((s, p, o, g) for s, p, o in graph_triples)
+        graphs[uri] = g
+    return graphs
+
+
+def get_modified_datasets(
+    local_datasets: Dict[str, str]
+) -> Dict[str, Tuple[List[Tuple], List[Tuple], List[Tuple]]]:
+    """Gets the graphs that have been modified, mapped to their (to_insert, to_delete)
+    triples without blank nodes & their changed groups of blank node triples.
+
+    Graphs without blank nodes are only fetched when their remote count & digest
+    differ, whereas graphs with blank nodes can't be digested so are always fetched
+    in full."""
+    modified = {}
+
+    # sketch each local graph, keeping only its count & digest rather than the graph,
+    # except for graphs with bnodes, which will be compared in full anyway
+    local_bnode_graphs = {}
+    local_sketches = {}
+    for uri, filename in local_datasets.items():
+        g_local = _parse_local(filename)
+        if _has_bnodes(g_local):
+            local_bnode_graphs[uri] = g_local
+        else:
+            local_sketches[uri] = (len(g_local), _digest(g_local))
+    changed = list(local_bnode_graphs.keys())
+
+    # only fetch graphs in full where the count & digest don't match the local graph
+    remote_sketches = get_remote_sketches(list(local_sketches.keys()))
+    for uri, sketch in remote_sketches.items():
+        if sketch != local_sketches[uri]:
+            changed.append(uri)
+
+    remote_graphs = get_remote_graphs(changed)
+    for uri in changed:
+        # compare remote vs local graphs
+        g_remote = remote_graphs.get(uri)
+        if g_remote is None:  # remote dataset doesn't exist
             continue
 
-        # accounts for bnodes
-        g_remote_str = to_isomorphic(g_remote).serialize(format="turtle")
-        # re-parsed as namespace order is not guaranteed
-        remote = Graph().parse(data=g_remote_str, format="turtle")
-
-        with open(filename, "rb") as f:
-            g_local = Graph().parse(f.read(), format="turtle")
-        # accounts for bnodes
-        g_local_str = to_isomorphic(g_local).serialize(format="turtle")
-        # tags that get omitted in remote version
-        g_local_str = g_local_str.replace("@en", "")
-        g_local_str = g_local_str.replace("^^xsd:string", "")
-        # re-parsed as namespace order is not guaranteed
-        local = Graph().parse(data=g_local_str, format="turtle")
-
-        # compare graphs are equal
-        if not isomorphic(remote, local):
-            modified.append(uri)
+        remote_plain, remote_bnode = _split_bnodes(g_remote)
+        g_local = local_bnode_graphs.pop(uri, None)
+        if g_local is None:
+            g_local = _parse_local(local_datasets[uri])
+        local_plain, local_bnode = _split_bnodes(g_local)
+
+        # without bnodes, triples are equal if their normalised keys are equal
+        remote = _triple_map(remote_plain)
+        local = _triple_map(local_plain)
+        to_insert = [local[k] for k in local.keys() - remote.keys()]
+        to_delete = [remote[k] for k in remote.keys() - local.keys()]
+
+        # bnodes can only be matched up by canonicalising both sides of each group
+        bnode_groups = []
+        for key, (remote_group, local_group) in _bnode_groups(
+            remote_bnode, local_bnode
+        ).items():
+            if isomorphic(_norm_graph(remote_group), _norm_graph(local_group)):
+                continue
+            if key is None:  # no named subject to match these up by, so replace all
+                bnode_groups = [(None, local_bnode)]
+                break
+            bnode_groups.append((remote_group, local_group))
+
+        if to_insert or to_delete or bnode_groups:
+            modified[uri] = (to_insert, to_delete, bnode_groups)
     return modified
 
 
-if __name__ == "__main__":
-    if DROP_ON_START:
-        sparql_update("DROP ALL")
-        sparql_update("CREATE GRAPH <system:>")
-        sparql_update("CREATE GRAPH <background:>")
+def get_state_fingerprint() -> str:
+    """Gets a cheap fingerprint of the triplestore's system graph map & IDs, from the
+    counts & digests of their ordered contents"""
+    r = sparql_query(
+        _PREFIXES
+        + f"""
+        SELECT ?links ?links_digest ?ids ?ids_digest
+        WHERE {{
+            {{
+                SELECT (COUNT(*) AS ?links) (MD5(GROUP_CONCAT(?link ; separator="\\n")) AS ?links_digest)
+                WHERE {{
+                    {{
+                        SELECT ?link
+                        WHERE {{
+                            GRAPH <system:> {{
+                                ?s rdfs:seeAlso ?o .
+                            }}
+                            BIND (CONCAT(STR(?s), " ", STR(?o)) AS ?link)
+                        }}
+                        ORDER BY ?link
+                    }}
+                }}
+            }}
+            {{
+                SELECT (COUNT(*) AS ?ids) (MD5(GROUP_CONCAT(?pair ; separator="\\n")) AS ?ids_digest)
+                WHERE {{
+                    {{
+                        SELECT ?pair
+                        WHERE {{
+                            ?content dcterms:identifier ?id .
+                            BIND (CONCAT(STR(?content), " ", STR(?id)) AS ?pair)
+                        }}
+                        ORDER BY ?pair
+                    }}
+                }}
+            }}
+        }}
+    """
+    )
+    return "|".join(
+        [DB_BASE_URI]
+        + [
+            r[0].get(var, {}).get("value", "")
+            for var in ("links", "links_digest", "ids", "ids_digest")
+        ]
+    )
 
-        # add ontology files to <background:> graph
-        for ont_file in Path(__file__).parent.parent.glob("ontologies/**/*.ttl"):
-            with open(ont_file, "rb") as f:
-                sparql_insert_graph("background:", f.read())
+
+def load_state() -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Gets the content graph to system graph map & the ID map, reusing the cached
+    copy when the triplestore's fingerprint hasn't changed"""
+    fingerprint = get_state_fingerprint()
+    try:
+        with open(STATE_CACHE) as f:
+            state = json.load(f)
+        if state["fingerprint"] == fingerprint:
+            return state["mapping"], state["ids"]
+    except (OSError, json.JSONDecodeError, KeyError, TypeError):
+        pass  # a missing or unreadable cache is a miss
 
     # query DB for content graph to system graph map, store in python dict
     r = sparql_query(
-        f"""
-        PREFIX rdfs: <{RDFS}>
+        _PREFIXES
+        + f"""
         SELECT ?content ?system
         WHERE {{
             GRAPH <system:> {{
@@ -335,41 +816,78 @@ if __name__ == "__main__":
         }}
     """
     )
-    mapping_dict = {
-        result["content"]["value"]: result["system"]["value"] for result in r
-    }
+    mapping = {result["content"]["value"]: result["system"]["value"] for result in r}
 
     # query DB for all IDs, store in dict for uniqueness checking
     r = sparql_query(
-        f"""
-        PREFIX dcterms: <{DCTERMS}>
+        _PREFIXES
+        + f"""
         SELECT ?content ?id
         WHERE {{
             ?content dcterms:identifier ?id .
         }}
     """
     )
-    id_dict = {result["content"]["value"]: result["id"]["value"] for result in r}
+    ids = {result["content"]["value"]: result["id"]["value"] for result in r}
+
+    # write to a temp file first, so an interrupted run can't leave a truncated cache
+    STATE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = STATE_CACHE.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"fingerprint": fingerprint, "mapping": mapping, "ids": ids}, f)
+    os.replace(tmp, STATE_CACHE)
+    return mapping, ids
+
+
+def invalidate_state() -> None:
+    """Removes the cached system graph map & IDs after the triplestore changes"""
+    STATE_CACHE.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    if DROP_ON_START:
+        sparql_update("DROP ALL")
+        sparql_update("CREATE GRAPH <system:>")
+        sparql_update("CREATE GRAPH <background:>")
+
+        # add ontology files to <background:> graph
+        for ont_file in Path(__file__).parent.parent.glob("ontologies/**/*.ttl"):
+            with open(ont_file, "rb") as f:
+                sparql_insert_graph("background:", f)
+
+    # query the triplestore while parsing local datasets, as these are independent
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        # content graph to system graph map & all IDs, from the cache if unchanged
+        f_state = executor.submit(load_state)
+        f_remote = executor.submit(get_remote_datasets)
+        f_local = executor.submit(get_local_datasets)
+        mapping_dict, id_dict = f_state.result()
+        remote_datasets = f_remote.result()
+        local_datasets = f_local.result()  # {uri: file, ...}
+
+    # reverse index of id_dict for O(1) uniqueness checks
+    id_to_uri = {id: uri for uri, id in id_dict.items()}
 
     # check if id dict has distinct values
-    assert len(set(id_dict.values())) == len(id_dict.values()), "Found duplicate IDs"
+    assert len(id_to_uri) == len(id_dict), "Found duplicate IDs"
 
-    # gets remote & local datasets
-    remote_datasets = get_remote_datasets()
+    # output remote & local datasets
     print(f"remote datasets: {remote_datasets}")
-    local_datasets = get_local_datasets()  # {uri: file, ...}
     local_datasets_list = list(local_datasets.keys())
     print(f"local datasets: {local_datasets_list}")
 
-    modified_datasets = get_modified_datasets(local_datasets)
+    # {uri: (to_insert, to_delete, bnode_groups)}
+    modified = get_modified_datasets(local_datasets)
+    modified_datasets = list(modified.keys())
     print(f"modified datasets: {modified_datasets}")
-    to_be_added, to_be_deleted = get_diff(local_datasets_list, remote_datasets)
+    to_be_added, to_be_deleted = get_diff(local_datasets.keys(), remote_datasets)
     print(f"added datasets: {to_be_added}")
     print(f"removed datasets: {to_be_deleted}")
 
     # make changes
-    delete_datasets(to_be_deleted + modified_datasets)
-    add_datasets(modified_datasets + to_be_added, local_datasets)
+    delete_datasets(to_be_deleted)
+    add_datasets(to_be_added, local_datasets)
+    update_datasets(modified, local_datasets)
 
     # output the changes
     print("added:")
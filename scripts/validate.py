@@ -1,10 +1,55 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import hashlib
+import json
+import os
+from typing import Optional, Tuple
 
 from pyshacl import validate
+from rdflib import Graph
 import httpx
 
 from config import *
 
+VALIDATE_CACHE = Path(__file__).parent.parent / ".cache" / "validate_results.json"
+
+# SHACL graph parsed once per worker process
+_shacl_graph: Optional[Graph] = None
+
+
+def _init_worker(shacl_text: str) -> None:
+    """Parses the SHACL validator once so it can be reused for every file"""
+    global _shacl_graph
+    _shacl_graph = Graph().parse(data=shacl_text, format="ttl")
+
+
+def _file_hash(path: Path) -> str:
+    """Gets the SHA-256 hash of a file, streamed in chunks"""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+def _validate_one(path: Path) -> Tuple[str, Optional[str], Optional[str]]:
+    """Validates a single dataset file, returning (filename, warning_msg, error_msg)"""
+    try:
+        v = validate(str(path), shacl_graph=_shacl_graph)
+        if not v[0]:
+            if "Severity: sh:Violation" in v[2]:
+                return path.name, None, v[2]
+            elif "Severity: sh:Warning" in v[2]:
+                return path.name, v[2], None
+
+    # syntax errors crash the validate() function
+    except Exception as e:
+        return path.name, None, str(e)
+
+    return path.name, None, None
+
 
 def main():
     # get the validator
@@ -19,20 +64,44 @@ def main():
     warning_datasets = {}  # format {dataset_filename: warning_msg}
     invalid_datasets = {}  # format {dataset_filename: error_msg}
     datasets_dir = Path(__file__).parent.parent / "data"
-    for f in datasets_dir.glob("**/*"):
-        # ...validate each file
-        if f.name.endswith(".ttl"):
-            try:
-                v = validate(str(f), shacl_graph=r.text, shacl_graph_format="ttl")
-                if not v[0]:
-                    if "Severity: sh:Violation" in v[2]:
-                        invalid_datasets[f.name] = v[2]
-                    elif "Severity: sh:Warning" in v[2]:
-                        warning_datasets[f.name] = v[2]
-
-            # syntax errors crash the validate() function
-            except Exception as e:
-                invalid_datasets[f.name] = e
+    files = [f for f in datasets_dir.glob("**/*") if f.name.endswith(".ttl")]
+
+    # reuse results for files where neither the file nor the validator has changed
+    try:
+        with open(VALIDATE_CACHE) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, json.JSONDecodeError):
+        cache = {}  # a missing or unreadable cache is a miss
+    shacl_hash = hashlib.sha256(r.content).hexdigest()
+    keys = {f: _file_hash(f) + shacl_hash for f in files}
+    results = {f: (f.name, *cache[keys[f]]) for f in files if keys[f] in cache}
+    to_validate = [f for f in files if f not in results]
+
+    # ...validate each file in parallel, as each file is independent
+    if to_validate:
+        # each worker parses the validator, so don't start more than there are files
+        with ProcessPoolExecutor(
+            max_workers=min(len(to_validate), os.cpu_count() or 1),
+            initializer=_init_worker,
+            initargs=(r.text,),
+        ) as executor:
+            for f, result in zip(
+                to_validate, executor.map(_validate_one, to_validate, chunksize=4)
+            ):
+                results[f] = result
+
+    # write to a temp file first, so an interrupted run can't leave a truncated cache
+    VALIDATE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = VALIDATE_CACHE.with_suffix(".tmp")
+    with open(tmp, "w") as cache_file:
+        json.dump({keys[f]: results[f][1:] for f in files}, cache_file)
+    os.replace(tmp, VALIDATE_CACHE)
+
+    for name, warning, error in results.values():
+        if error is not None:
+            invalid_datasets[name] = error
+        elif warning is not None:
+            warning_datasets[name] = warning
 
     # check to see if we have any invalid datasets
     if len(warning_datasets.keys()) > 0 and SHOW_WARNINGS:
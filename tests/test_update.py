@@ -0,0 +1,200 @@
+import pytest
+from rdflib import Dataset, Graph, URIRef, BNode, Literal, namespace
+from rdflib.compare import isomorphic
+
+import update
+from update import (
+    get_graph_uri_for_dataset,
+    get_remote_sketches,
+    get_modified_datasets,
+    add_datasets,
+    update_datasets,
+    _digest,
+)
+
+PREFIXES = """
+@prefix dcat: <http://www.w3.org/ns/dcat#> .
+@prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .
+@prefix ex: <http://example.org/> .
+"""
+
+
+@pytest.mark.parametrize(
+    "turtle",
+    [
+        # prefixed name subject
+        PREFIXES + "ex:ds a dcat:Dataset .",
+        # full IRI subject & rdf:type
+        PREFIXES + "<http://example.org/ds> rdf:type dcat:Dataset .",
+        # type in an object list, after other predicates
+        PREFIXES + "ex:ds a ex:Thing, dcat:Dataset ;\n    ex:p ex:o .",
+        # type not the first predicate
+        PREFIXES + "ex:ds ex:p ex:o ;\n    a dcat:Dataset .",
+        # SPARQL-style prefixes
+        "PREFIX dcat: <http://www.w3.org/ns/dcat#>\n"
+        "PREFIX ex: <http://example.org/>\n"
+        "ex:ds a dcat:Dataset .",
+        # empty prefix relative to the base
+        "@base <http://example.org/> .\n@prefix : <> .\n"
+        "@prefix dcat: <http://www.w3.org/ns/dcat#> .\n:ds a dcat:Dataset .",
+        # relative IRI subject
+        "@base <http://example.org/> .\n"
+        "@prefix dcat: <http://www.w3.org/ns/dcat#> .\n<ds> a dcat:Dataset .",
+        # prefix redeclared after the dataset
+        PREFIXES
+        + "ex:ds a dcat:Dataset .\n@prefix ex: <http://example.com/> .\nex:x ex:p 1 .",
+        # other typed subjects before the dataset
+        PREFIXES + "ex:fc a ex:FeatureCollection .\nex:ds a dcat:Dataset .",
+        # lowercase SPARQL-style prefix redeclaring a turtle one
+        "@prefix dcat: <http://www.w3.org/ns/dcat#> .\n@prefix ex: <http://a/> .\n"
+        "prefix ex: <http://b/>\nex:ds a dcat:Dataset .",
+        # a dataset statement inside a long string
+        PREFIXES
+        + 'ex:x ex:p """\nex:fake a dcat:Dataset .\n""" .\nex:ds a dcat:Dataset .',
+        PREFIXES
+        + "ex:x ex:p '''\nex:fake a dcat:Dataset .\n''' .\nex:ds a dcat:Dataset .",
+        # a dataset statement before a long string
+        PREFIXES + 'ex:ds a dcat:Dataset ;\n    ex:p """long\nstring""" .',
+        # escaped IRI
+        PREFIXES + "<http://example.org/d\\u0073> a dcat:Dataset .",
+    ],
+)
+def test_graph_uri_matches_rdflib(tmp_path, turtle):
+    path = tmp_path / "dataset.ttl"
+    path.write_text(turtle)
+    g = Graph().parse(str(path), format="turtle")
+    expected = next(g.subjects(namespace.RDF.type, namespace.DCAT.Dataset))
+
+    assert get_graph_uri_for_dataset(path) == expected
+
+
+def _binding(term):
+    """Formats a term as a SPARQL JSON result binding"""
+    if isinstance(term, URIRef):
+        return {"type": "uri", "value": str(term)}
+    if isinstance(term, BNode):
+        return {"type": "bnode", "value": str(term)}
+    binding = {"type": "literal", "value": str(term)}
+    if term.language:
+        binding["xml:lang"] = term.language
+    if term.datatype:
+        binding["datatype"] = str(term.datatype)
+    return binding
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    """An in-memory Dataset standing in for the triplestore"""
+    d = Dataset()
+
+    def query_many(queries):
+        return [
+            [
+                {str(k): _binding(v) for k, v in row.asdict().items()}
+                for row in d.query(q)
+            ]
+            for q in queries
+        ]
+
+    def insert_graph(graph_uri, graph_content, content_type="text/turtle"):
+        if not isinstance(graph_content, bytes):
+            graph_content = graph_content.read()
+        d.graph(URIRef(graph_uri)).parse(
+            data=graph_content,
+            format="nt" if content_type == "application/n-triples" else "turtle",
+        )
+        return True
+
+    monkeypatch.setattr(update, "sparql_query_many", query_many)
+    monkeypatch.setattr(update, "sparql_update", lambda q: d.update(q) or True)
+    monkeypatch.setattr(update, "sparql_insert_graph", insert_graph)
+    monkeypatch.setattr(update, "STATE_CACHE", tmp_path / "state.json")
+    for name in ("mapping_dict", "id_dict", "id_to_uri"):
+        monkeypatch.setattr(update, name, {}, raising=False)
+    return d
+
+
+SKETCH_GRAPH = """
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+@prefix ex: <http://example.org/> .
+
+ex:s ex:iri ex:o ;
+    ex:plain "plain" ;
+    ex:string "string"^^xsd:string ;
+    ex:en "english"@en ;
+    ex:fr "français"@fr ;
+    ex:integer "01"^^xsd:integer ;
+    ex:double "1.0E0"^^xsd:double ;
+    ex:decimal 1.50 ;
+    ex:dateTime "2021-03-01T00:00:00Z"^^xsd:dateTime ;
+    ex:custom "custom"^^ex:datatype .
+ex:s2 ex:iri ex:s .
+"""
+
+
+def test_remote_sketch_matches_digest(store):
+    g = store.graph(URIRef("http://example.org/graph"))
+    g.parse(data=SKETCH_GRAPH, format="turtle")
+    local = Graph().parse(data=SKETCH_GRAPH, format="turtle")
+
+    assert get_remote_sketches([str(g.identifier)]) == {
+        str(g.identifier): (len(local), _digest(local))
+    }
+
+
+DATASET = """
+@prefix dcat: <http://www.w3.org/ns/dcat#> .
+@prefix dcterms: <http://purl.org/dc/terms/> .
+@prefix geo: <http://www.opengis.net/ont/geosparql#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+@prefix ex: <http://example.org/> .
+
+ex:ds a dcat:Dataset ;
+    dcterms:title "Dataset" ;
+    dcterms:created "2021-04-29"^^xsd:date ;
+    ex:count "01"^^xsd:integer .
+
+ex:fc a geo:FeatureCollection ;
+    dcterms:isPartOf ex:ds .
+
+ex:f1 a geo:Feature ;
+    dcterms:isPartOf ex:fc ;
+    geo:hasGeometry [ a geo:Geometry ;
+        geo:asWKT "POINT (1 1)"^^geo:wktLiteral ] .
+
+ex:f2 a geo:Feature ;
+    dcterms:isPartOf ex:fc ;
+    geo:hasGeometry [ a geo:Geometry ;
+        geo:asWKT "POINT (2 2)"^^geo:wktLiteral ] .
+"""
+
+
+def test_update_applies_changes(store, tmp_path):
+    uri = "http://example.org/ds"
+    path = tmp_path / "dataset.ttl"
+    path.write_text(DATASET)
+    add_datasets([uri], {uri: path})
+
+    # a literal, a typed literal & a blank node triple
+    path.write_text(
+        DATASET.replace('"Dataset"', '"Changed"')
+        .replace("2021-04-29", "2021-05-01")
+        .replace("POINT (2 2)", "POINT (3 3)")
+    )
+    modified = get_modified_datasets({uri: path})
+
+    to_insert, to_delete, bnode_groups = modified[uri]
+    assert {o for _, _, o in to_insert} == {
+        Literal("Changed"),
+        Literal("2021-05-01", datatype=namespace.XSD.date),
+    }
+    assert len(to_delete) == 2
+    # only the changed feature's geometry is replaced
+    assert [(len(remote), len(local)) for remote, local in bnode_groups] == [(3, 3)]
+
+    update_datasets(modified, {uri: path})
+
+    assert isomorphic(
+        store.graph(URIRef(uri)), Graph().parse(str(path), format="turtle")
+    )
+    assert get_modified_datasets({uri: path}) == {}